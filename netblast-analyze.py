@@ -18,6 +18,12 @@ def netflowMatches(src_ip,dest_ip,src_patterns,dest_patterns):
         return False
     return True
 
+def formatTime(t,dt):
+    if dt == int(dt):
+        return round(t)
+    # microsecond precision, matching the flow timestamps
+    return round(t,6)
+
 def analyzeNetBlastLog(logfile,outputcsv,src,dest,dt,debug):
     F = open(logfile,"r")
     records = []
@@ -59,11 +65,38 @@ def analyzeNetBlastLog(logfile,outputcsv,src,dest,dt,debug):
 
     csvout.writerow(["t","duration","bps","bytes","tx_IPs","txrx_IPs",])
 
-    for t in range(int(min_time),int(max_time),dt):
+    # Whole-second steps run between the whole seconds in which the flows start
+    # and end.  Other steps start at the first flow and run to the end of the last one.
+    if dt == int(dt):
+        start_time = int(min_time)
+        end_time = int(max_time)
+    else:
+        start_time = min_time
+        end_time = max_time
+
+    # sweep through the flows in order of start time, keeping track of the ones that may overlap this time step
+    records.sort(key=lambda rec: rec['start_time'])
+    next_record = 0
+    active = []
+
+    # write whole-second steps as integers, as with the original integer --dt
+    dt_column = dt
+    if dt == int(dt):
+        dt_column = int(dt)
+
+    step = 0
+    while start_time + step*dt < end_time:
+        t = start_time + step*dt
+        step += 1
+        while next_record < len(records) and records[next_record]['start_time'] < t+dt:
+            active.append(records[next_record])
+            next_record += 1
+        active = [rec for rec in active if rec['end_time'] > t]
+
         bytes_sent = 0
         src_ips = {}
         dest_ips = {}
-        for rec in records:
+        for rec in active:
             if rec['start_time'] < t+dt and rec['end_time'] > t:
                 delta = min(rec['end_time'],t+dt) - max(rec['start_time'],t)
                 bytes_sent += rec['bytes_sent']/(1.0*rec['elapsed'])*delta
@@ -92,7 +125,7 @@ def analyzeNetBlastLog(logfile,outputcsv,src,dest,dt,debug):
                     d = dest_ips[src_ip]
                 num_src_and_dest_ips += d*1.0/dt
 
-        csvout.writerow([round(t-min_time),dt,round(flow),round(bytes_sent),round(num_src_ips),round(num_src_and_dest_ips)])
+        csvout.writerow([formatTime(t-min_time,dt),dt_column,round(flow),round(bytes_sent),round(num_src_ips),round(num_src_and_dest_ips)])
 
 if __name__ == "__main__":
     import argparse
@@ -101,9 +134,11 @@ if __name__ == "__main__":
     parser.add_argument('--debug', action='store_true')
     parser.add_argument('--src',action='append',help='Filter by IP address of source. (May use option multiple times.)')
     parser.add_argument('--dest',action='append',help='Filter by IP address of destination. (May use option multiple times.)')
-    parser.add_argument('--dt',default=30,type=int,help='time delta between output records')
+    parser.add_argument('--dt',default=30,type=float,help='time delta in seconds between output records (may be fractional)')
     parser.add_argument('logfile')
     parser.add_argument('outputcsv')
 
     args = parser.parse_args()
+    if args.dt <= 0:
+        parser.error("--dt must be positive")
     analyzeNetBlastLog(args.logfile,args.outputcsv,args.src,args.dest,args.dt,args.debug)
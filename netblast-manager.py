@@ -9,22 +9,44 @@ import ipaddress
 import sys
 import threading
 import signal
+import struct
+import bisect
+import cProfile
+import pstats
+import os
 
 KEEPALIVE_TIMEOUT = 120
 RETRY_INTERVAL = 10
 BLAST_CLIENT_DURATION = 60
 TEST_DURATION = 120
 MAX_CONNECT_ERRORS = 3
+STATS_INTERVAL = 60
+PROFILE_PRINT_LINES = 30
+CHECKPOINT_INTERVAL = 5
+COMPACT_MIN_ENTRIES = 1000
+COMPACT_FACTOR = 4
+# save a worker's last contact time once it has moved this much since it was last saved
+CONTACT_SAVE_INTERVAL = KEEPALIVE_TIMEOUT/4
+# maximum rate (per second) at which workers are told to re-register
+REREGISTER_RATE = 50
+
+# upper bounds (seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = [0.00005,0.0001,0.0002,0.0005,0.001,0.002,0.005,0.01,0.02,0.05,0.1,0.2,0.5,1,2,5]
+
+KNOWN_COMMANDS = ['get_work','register_worker','keep_alive','report_flow','connect_failed','stats','reregister','unknown']
 
 class NetBlastHandler(socketserver.BaseRequestHandler):
 
     def handle(self):
+        handle_started = time.perf_counter()
+        cmd = None
         try:
             data = ""
             while True:
                 more_data = str(self.request.recv(1024),"utf-8")
                 if len(more_data)==0: break
                 data += more_data
+            received_time = time.time()
             if self.server.debug:
                 print("Received from {}: {}".format(self.client_address[0],data))
 
@@ -34,11 +56,13 @@ class NetBlastHandler(socketserver.BaseRequestHandler):
                 req['ip'] = self.client_address[0]
 
             q = req['q']
+            cmd = q
             if 'worker_id' in req and req['worker_id'] not in self.server.workers:
+                cmd = 'reregister'
                 res = {}
                 res['success'] = False
                 res['reregister'] = True
-                res['retry_after'] = 1
+                res['retry_after'] = self.server.reregisterDelay()
                 res['error_msg'] = "Worker ID " + str(req['worker_id']) + " not found.  Reregister."
             elif q == 'get_work':
                 res = self.server.getWork(self,req)
@@ -50,10 +74,20 @@ class NetBlastHandler(socketserver.BaseRequestHandler):
                 res = self.server.reportFlow(self,req)
             elif q == 'connect_failed':
                 res = self.server.reportConnectFailed(self,req)
+            elif q == 'stats':
+                res = self.server.getStats(self,req)
             else:
+                cmd = 'unknown'
                 print("Unknown command from {}: {}".format(self.client_address[0],data))
                 res = {'success': False, 'message': "Unknown command '" + q + "'"}
 
+            if 'client_time' in req:
+                # timestamps for the worker's estimate of its clock offset from ours
+                if res is None:
+                    res = {'success': True}
+                res['server_receive_time'] = received_time
+                res['server_send_time'] = time.time()
+
             if self.server.debug:
                 print("Response to {}: {}".format(self.client_address[0],res))
                 sys.stdout.flush()
@@ -61,10 +95,13 @@ class NetBlastHandler(socketserver.BaseRequestHandler):
             self.request.sendall(bytes(json.dumps(res),"utf-8"))
 
         except Exception as error:
+            self.server.request_errors += 1
             print("Error handling request from " + self.client_address[0] + ":",error)
             print("Request string from " + self.client_address[0] + " was: " + repr(data))
             print(traceback.format_exc())
 
+        self.server.recordRequest(cmd,time.perf_counter() - handle_started)
+
 class NetBlastServer(socketserver.TCPServer):
     request_queue_size = 100 # override default of 5 to withstand request storms
     allow_reuse_address = True
@@ -79,12 +116,122 @@ class NetBlastServer(socketserver.TCPServer):
     ramp_delay = None
     ramp_level = 0
     last_ramp_level_increment = None
+    stats_interval = STATS_INTERVAL
+    last_stats_summary = None
+    command_stats = None
+    request_errors = 0
+    backlog_samples = 0
+    backlog_total = 0
+    backlog_max = 0
+    backlog_last = None
+    sched_searches = 0
+    sched_scanned = 0
+    sched_max_scan = 0
+    sched_assigned = 0
+    profiler = None
+    state_file = None
+    state_log = None
+    state_log_entries = 0
+    dirty_workers = None
+    last_checkpoint = None
+    saved_contact = None
+    next_reregister_slot = 0
 
     def __init__(self,addr,handler):
         super().__init__(addr,handler)
         self.test_started = time.time()
+        self.last_stats_summary = time.time()
         self.workers = {}
         self.ids = set()
+        self.dirty_workers = set()
+        self.saved_contact = {}
+        self.command_stats = {}
+        for cmd in KNOWN_COMMANDS:
+            self.command_stats[cmd] = newCommandStats()
+
+    def recordRequest(self,cmd,elapsed):
+        if cmd not in self.command_stats:
+            cmd = 'unknown'
+        cmd_stats = self.command_stats[cmd]
+        cmd_stats['count'] += 1
+        cmd_stats['total_time'] += elapsed
+        if elapsed > cmd_stats['max_time']:
+            cmd_stats['max_time'] = elapsed
+        cmd_stats['histogram'][bisect.bisect_left(LATENCY_BUCKETS,elapsed)] += 1
+
+    def sampleAcceptBacklog(self):
+        backlog = acceptBacklog(self.socket)
+        if backlog is None: return
+        self.backlog_last = backlog
+        self.backlog_samples += 1
+        self.backlog_total += backlog
+        if backlog > self.backlog_max:
+            self.backlog_max = backlog
+
+    def service_actions(self):
+        # called by serve_forever() after each request and whenever it is idle
+        self.sampleAcceptBacklog()
+        if self.state_file and time.time() - self.last_checkpoint >= CHECKPOINT_INTERVAL:
+            self.checkpointState()
+        if self.stats_interval and time.time() - self.last_stats_summary >= self.stats_interval:
+            self.printStatsSummary()
+
+    def statsSnapshot(self):
+        stats = {}
+        stats['uptime'] = round(time.time() - self.test_started,3)
+        stats['workers'] = len(self.workers)
+        stats['ramp_level'] = self.ramp_level
+        stats['request_errors'] = self.request_errors
+        stats['backlog_last'] = self.backlog_last
+        stats['backlog_max'] = self.backlog_max
+        stats['backlog_mean'] = round(self.backlog_total/self.backlog_samples,2) if self.backlog_samples else None
+        stats['request_queue_size'] = self.request_queue_size
+        stats['sched_searches'] = self.sched_searches
+        stats['sched_assigned'] = self.sched_assigned
+        stats['sched_success_rate'] = round(self.sched_assigned/self.sched_searches,3) if self.sched_searches else None
+        stats['sched_mean_scan'] = round(self.sched_scanned/self.sched_searches,1) if self.sched_searches else None
+        stats['sched_max_scan'] = self.sched_max_scan
+        stats['latency_buckets'] = LATENCY_BUCKETS
+        commands = {}
+        for cmd,cmd_stats in self.command_stats.items():
+            if not cmd_stats['count']: continue
+            commands[cmd] = {}
+            commands[cmd]['count'] = cmd_stats['count']
+            commands[cmd]['mean_ms'] = round(cmd_stats['total_time']/cmd_stats['count']*1000,3)
+            commands[cmd]['p99_ms'] = round(histogramPercentile(cmd_stats['histogram'],0.99,cmd_stats['max_time'])*1000,3)
+            commands[cmd]['max_ms'] = round(cmd_stats['max_time']*1000,3)
+            commands[cmd]['histogram'] = list(cmd_stats['histogram'])
+        stats['commands'] = commands
+        return stats
+
+    def printStatsSummary(self):
+        self.last_stats_summary = time.time()
+        stats = self.statsSnapshot()
+        line = "STATS: t=" + str(round(stats['uptime']))
+        line += " workers=" + str(stats['workers'])
+        line += " ramp=" + str(stats['ramp_level'])
+        line += " errors=" + str(stats['request_errors'])
+        line += " backlog=" + str(stats['backlog_last']) + "/" + str(stats['backlog_max'])
+        line += " sched=" + str(stats['sched_assigned']) + "/" + str(stats['sched_searches'])
+        line += " scan=" + str(stats['sched_mean_scan']) + "/" + str(stats['sched_max_scan'])
+        for cmd,cmd_stats in stats['commands'].items():
+            line += " " + cmd + "=" + str(cmd_stats['count']) + ":" + str(cmd_stats['mean_ms']) + "/" + str(cmd_stats['p99_ms']) + "/" + str(cmd_stats['max_ms']) + "ms"
+        print(line)
+        sys.stdout.flush()
+
+    def getStats(self,handler,req):
+        res = {}
+        res['success'] = True
+        res['stats'] = self.statsSnapshot()
+        return res
+
+    def reregisterDelay(self):
+        # Give each worker that must re-register its own time slot, so that after
+        # a restart they arrive no faster than REREGISTER_RATE, however many there are.
+        now = time.time()
+        slot_width = 1.0/REREGISTER_RATE
+        self.next_reregister_slot = max(self.next_reregister_slot,now + 1) + slot_width
+        return self.next_reregister_slot - now + random.uniform(-slot_width,0)
 
     def getNewWorkerID(self):
         while True:
@@ -115,6 +262,7 @@ class NetBlastServer(socketserver.TCPServer):
             print("Warning: worker with IP",worker['ip'],"is not in client or server networks, so it will not participate.")
 
         self.workers[worker_id] = worker
+        self.dirty_workers.add(worker_id)
 
         if self.debug:
             print("Registered worker: " + repr(worker))
@@ -122,10 +270,19 @@ class NetBlastServer(socketserver.TCPServer):
         res = {}
         res['success'] = True
         res['worker_id'] = worker_id
+        if self.test_duration:
+            res['test_ends_in'] = self.testEndsIn(time.time())
         return res
 
+    def testEndsIn(self,now):
+        return self.test_duration - (now - self.test_started)
+
     def keepalive(self,handler,req):
-        self.workers[req['worker_id']]['last_contact'] = time.time()
+        now = time.time()
+        worker_id = req['worker_id']
+        self.workers[worker_id]['last_contact'] = now
+        if self.state_file and now - self.saved_contact.get(worker_id,0) >= CONTACT_SAVE_INTERVAL:
+            self.dirty_workers.add(worker_id)
 
     def getWork(self,handler,req):
         self.keepalive(handler,req)
@@ -133,6 +290,8 @@ class NetBlastServer(socketserver.TCPServer):
         req_ip = req['ip']
         res = {}
         now = time.time()
+        if self.test_duration:
+            res['test_ends_in'] = self.testEndsIn(now)
 
         ramp_level_delta = 1
 
@@ -140,6 +299,7 @@ class NetBlastServer(socketserver.TCPServer):
         for worker_id,server_worker in self.workers.items():
             if server_worker['blast_client'] == req['worker_id']:
                 server_worker['blast_client'] = None
+                self.dirty_workers.add(worker_id)
                 ramp_level_delta -= 1
 
         if not client_worker['in_client_networks']:
@@ -165,7 +325,9 @@ class NetBlastServer(socketserver.TCPServer):
                 return res
 
         blast_server = None
+        scanned = 0
         for server_worker_id,server_worker in self.workers.items():
+            scanned += 1
             server_worker_ip = server_worker['ip']
             if not server_worker['in_server_networks']: continue
             if server_worker['blast_client'] and now - self.workers[server_worker['blast_client']]['last_contact'] < KEEPALIVE_TIMEOUT: continue
@@ -178,6 +340,13 @@ class NetBlastServer(socketserver.TCPServer):
             blast_server = server_worker
             break
 
+        self.sched_searches += 1
+        self.sched_scanned += scanned
+        if scanned > self.sched_max_scan:
+            self.sched_max_scan = scanned
+        if blast_server:
+            self.sched_assigned += 1
+
         if not blast_server:
             res['success'] = False
             if now - self.test_started < self.test_duration:
@@ -193,6 +362,7 @@ class NetBlastServer(socketserver.TCPServer):
                 self.last_ramp_level_increment = now
 
             blast_server['blast_client'] = req['worker_id']
+            self.dirty_workers.add(blast_server['worker_id'])
             res['success'] = True
             res['blast_ip'] = blast_server['ip']
             res['blast_port'] = blast_server['blast_port']
@@ -220,13 +390,141 @@ class NetBlastServer(socketserver.TCPServer):
     def reportConnectFailed(self,handler,req):
         server = self.workers[req['blast_id']]
         server['connect_errors'] += 1
+        self.dirty_workers.add(req['blast_id'])
         if server['connect_errors'] == MAX_CONNECT_ERRORS+1:
             print("Will no longer use failing server at ",server['ip'] + ":" + str(server['blast_port']),": ",req['error'])
 
+    def serverState(self):
+        state = {}
+        state['test_started'] = self.test_started
+        state['ramp_level'] = self.ramp_level
+        state['last_ramp_level_increment'] = self.last_ramp_level_increment
+        state['checkpoint_time'] = time.time()
+        return state
+
+    def writeStateEntry(self,F,entry):
+        F.write(json.dumps(entry) + "\n")
+        self.state_log_entries += 1
+
+    def writeWorkerEntry(self,F,worker):
+        self.writeStateEntry(F,{'worker': worker})
+        self.saved_contact[worker['worker_id']] = worker['last_contact']
+
+    def compactState(self):
+        # rewrite the log as a snapshot of the current state and atomically replace the old one
+        if self.state_log:
+            self.state_log.close()
+        self.state_log_entries = 0
+        tmp_file = self.state_file + ".tmp"
+        F = open(tmp_file,"w")
+        self.writeStateEntry(F,{'server': self.serverState()})
+        for worker in self.workers.values():
+            self.writeWorkerEntry(F,worker)
+        F.close()
+        os.replace(tmp_file,self.state_file)
+        self.state_log = open(self.state_file,"a")
+        self.dirty_workers.clear()
+
+    def checkpointState(self):
+        self.last_checkpoint = time.time()
+        if self.state_log_entries > COMPACT_MIN_ENTRIES and self.state_log_entries > COMPACT_FACTOR*len(self.workers):
+            self.compactState()
+            return
+        # the server entry records when this checkpoint was taken
+        self.writeStateEntry(self.state_log,{'server': self.serverState()})
+        for worker_id in self.dirty_workers:
+            self.writeWorkerEntry(self.state_log,self.workers[worker_id])
+        self.dirty_workers.clear()
+        self.state_log.flush()
+
+    def loadState(self,state_file):
+        self.state_file = state_file
+        self.last_checkpoint = time.time()
+        if os.path.exists(state_file):
+            server_state = None
+            workers = {}
+            F = open(state_file,"r")
+            for line in F:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a partially written entry from an interrupted checkpoint
+                    print("Ignoring corrupt entry in state file",state_file + ":",repr(line))
+                    continue
+                if 'server' in entry:
+                    server_state = entry['server']
+                if 'worker' in entry:
+                    workers[entry['worker']['worker_id']] = entry['worker']
+            F.close()
+
+            now = time.time()
+            if server_state and self.test_duration and now - server_state['test_started'] >= self.test_duration:
+                print("Ignoring state file",state_file,"from a test that has already ended.")
+            elif server_state:
+                self.test_started = server_state['test_started']
+                self.ramp_level = server_state['ramp_level']
+                self.last_ramp_level_increment = server_state['last_ramp_level_increment']
+                # Do not count the time the manager was down against the workers.
+                # Those that had already timed out stay timed out.
+                downtime = now - server_state['checkpoint_time']
+                for worker in workers.values():
+                    worker['last_contact'] += downtime
+                if self.last_ramp_level_increment:
+                    self.last_ramp_level_increment += downtime
+                self.workers = workers
+                self.ids = set(workers.keys())
+                print("Restored state of",len(workers),"workers from",state_file,"(test started",round(now - self.test_started),"seconds ago).")
+                sys.stdout.flush()
+        self.compactState()
+
     def stopSignal(self,signum,frame):
         self.shutting_down = True
         sys.stderr.write("Received interrupt.  Shutting down.\n")
 
+    def toggleProfiler(self,signum,frame):
+        # the signal is handled in the main thread, which is the one running serve_forever()
+        if self.profiler is None:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+            sys.stderr.write("Profiler enabled.  Send SIGUSR1 again to stop and print results.\n")
+            return
+        self.profiler.disable()
+        sys.stderr.write("Profiler disabled.\n")
+        pstats.Stats(self.profiler,stream=sys.stderr).sort_stats('cumulative').print_stats(PROFILE_PRINT_LINES)
+        sys.stderr.flush()
+        self.profiler = None
+
+def newCommandStats():
+    cmd_stats = {}
+    cmd_stats['count'] = 0
+    cmd_stats['total_time'] = 0.0
+    cmd_stats['max_time'] = 0.0
+    cmd_stats['histogram'] = [0] * (len(LATENCY_BUCKETS)+1)
+    return cmd_stats
+
+def histogramPercentile(histogram,fraction,max_time):
+    # returns the upper bound of the bucket containing the requested percentile,
+    # or the largest time actually seen, if that is smaller
+    total = sum(histogram)
+    if not total: return 0
+    needed = total*fraction
+    seen = 0
+    for i,count in enumerate(histogram):
+        seen += count
+        if seen >= needed:
+            break
+    if i < len(LATENCY_BUCKETS):
+        return min(LATENCY_BUCKETS[i],max_time)
+    return max_time
+
+def acceptBacklog(sock):
+    # In Linux, tcpi_unacked of a listening socket is the current accept queue length.
+    try:
+        info = sock.getsockopt(socket.IPPROTO_TCP,socket.TCP_INFO,32)
+        return struct.unpack_from("I",info,24)[0]
+    except (AttributeError,OSError,struct.error):
+        return None
+
 
 def whatsMyIP():
     try:
@@ -247,14 +545,17 @@ def considerShutdown(server):
     sys.stdout.flush()
     server.shutdown()
 
-def runNetBlastManager(host,port,debug,test_duration,client_networks,server_networks,direction,ramp_delay):
+def runNetBlastManager(host,port,debug,test_duration,client_networks,server_networks,direction,ramp_delay,stats_interval,state_file):
     server = NetBlastServer((host, port), NetBlastHandler)
     server.debug = debug
+    server.stats_interval = stats_interval
     server.test_duration = test_duration
     server.client_networks = client_networks
     server.server_networks = server_networks
     server.direction = direction
     server.ramp_delay = ramp_delay
+    if state_file:
+        server.loadState(state_file)
 
     if not host: host = str(server.server_address[0])
     port = str(server.server_address[1])
@@ -269,10 +570,17 @@ def runNetBlastManager(host,port,debug,test_duration,client_networks,server_netw
 
     signal.signal(signal.SIGINT, server.stopSignal)
     signal.signal(signal.SIGTERM, server.stopSignal)
+    signal.signal(signal.SIGUSR1, server.toggleProfiler)
 
     server.serve_forever()
     ender.join()
 
+    if server.stats_interval:
+        server.printStatsSummary()
+    if server.state_file:
+        server.checkpointState()
+        server.state_log.close()
+
 def ipMatches(ip,patterns,other_patterns):
     if patterns is None or len(patterns)==0:
         if other_patterns is None or len(other_patterns)==0: return True
@@ -298,6 +606,8 @@ if __name__ == "__main__":
     parser.add_argument('--servers',action='append',help='Network(s) that should act as servers. (May use option multiple times.)')
     parser.add_argument('--direction',default='s',choices=['s','r','b'],help="Direction of flow from client to server: (s)end, (r)eceive, (b)oth.")
     parser.add_argument('--ramp-delay',type=float,help='Number of seconds to wait before adding another transfer.')
+    parser.add_argument('--stats-interval',default=STATS_INTERVAL,type=float,help='Seconds between STATS summary lines in the log (0 to disable).')
+    parser.add_argument('--state-file',help='Periodically save the state of the test to this file and restore it when restarted.')
 
     args = parser.parse_args()
-    runNetBlastManager(args.host,args.port,args.debug,args.duration,args.clients,args.servers,args.direction,args.ramp_delay)
+    runNetBlastManager(args.host,args.port,args.debug,args.duration,args.clients,args.servers,args.direction,args.ramp_delay,args.stats_interval,args.state_file)
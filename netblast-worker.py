@@ -4,31 +4,90 @@ import threading
 import signal
 import socket
 import time
+import random
 import json
 import sys
 import os
 
 BLAST_BUFSIZE = 2**15
-
-def sendRequest(manager,request,debug):
-    request_json = json.dumps(request)
+MANAGER_RETRY_TIME = 300
+MANAGER_RETRY_INTERVAL = 10
+CLOCK_SAMPLES = 8
+
+# recent (offset,delay) measurements of our clock relative to the manager's
+clock_samples = []
+
+# Requests retry an unreachable manager (which may be restarting) until this
+# time.  None means give up on the first connection error.
+manager_retry_until = None
+
+# when the manager has told us the test will end, on our clock
+test_end_time = None
+
+def recordClockSample(client_send_time,server_receive_time,server_send_time,client_receive_time):
+    # NTP-style estimate, assuming the network delay is the same in both directions
+    offset = ((server_receive_time - client_send_time) + (server_send_time - client_receive_time))/2
+    delay = (client_receive_time - client_send_time) - (server_send_time - server_receive_time)
+    clock_samples.append((offset,delay))
+    if len(clock_samples) > CLOCK_SAMPLES:
+        del clock_samples[0]
+
+def clockOffset():
+    # use the sample with the least round-trip delay, since it has the smallest error bound
+    if not clock_samples:
+        return 0
+    return min(clock_samples,key=lambda sample: sample[1])[0]
+
+def managerTime(t):
+    return t + clockOffset()
+
+def sendRequest(manager,request,debug,resend=True):
+    global test_end_time
     if debug:
-        sys.stderr.write("Sending request to manager " + manager + ": " + request_json + "\n")
+        sys.stderr.write("Sending request to manager " + manager + ": " + json.dumps(request) + "\n")
 
     manager_addr = manager.split(':')
-    sock = socket.create_connection(manager_addr)
-    sock.sendall(bytes(request_json,"utf-8"))
-    sock.shutdown(socket.SHUT_WR)
-    response = ""
+    retry_until = None
+    if manager_retry_until is not None:
+        retry_until = min(manager_retry_until,time.time() + MANAGER_RETRY_TIME)
+        if test_end_time is not None:
+            retry_until = min(retry_until,test_end_time)
     while True:
-        r = str(sock.recv(1024),"utf-8")
-        if len(r)==0: break
-        response += r
-
-    if debug:
-        sys.stderr.write("Received response: " + response + "\n")
-
-    return json.loads(response)
+        request_sent = False
+        try:
+            with socket.create_connection(manager_addr) as sock:
+                request['client_time'] = time.time()
+                sock.sendall(bytes(json.dumps(request),"utf-8"))
+                request_sent = True
+                sock.shutdown(socket.SHUT_WR)
+                response = ""
+                while True:
+                    r = str(sock.recv(1024),"utf-8")
+                    if len(r)==0: break
+                    response += r
+            received_time = time.time()
+
+            if debug:
+                sys.stderr.write("Received response: " + response + "\n")
+
+            res = json.loads(response)
+            break
+        except (OSError,ValueError) as error:
+            # The manager may be restarting, so wait for it rather than giving up.
+            # Connections waiting to be accepted when it exits are reset and get no response.
+            if request_sent and not resend:
+                raise
+            retry_after = random.uniform(1,MANAGER_RETRY_INTERVAL)
+            if retry_until is None or time.time() + retry_after > retry_until:
+                raise
+            sys.stderr.write("Failed to contact manager " + manager + ": " + str(error) + ".  Retrying in " + str(round(retry_after,1)) + " seconds.\n")
+            time.sleep(retry_after)
+
+    if res and 'server_receive_time' in res:
+        recordClockSample(request['client_time'],res['server_receive_time'],res['server_send_time'],received_time)
+    if res and 'test_ends_in' in res:
+        test_end_time = received_time + res['test_ends_in']
+    return res
 
 stop_blast_server = False
 def stopBlastServer(signum,frame):
@@ -180,6 +239,7 @@ def blastClientProtocol(manager,worker_id,blast_ip,blast_port,blast_id,duration,
     stats['bytes_sent'] = 0
     stats['bytes_received'] = 0
     started = time.time()
+    started_counter = time.perf_counter()
 
     send_thread = receive_thread = None
     if direction == 's' or direction == 'b':
@@ -195,17 +255,23 @@ def blastClientProtocol(manager,worker_id,blast_ip,blast_port,blast_id,duration,
 
     sock.close()
 
-    elapsed = time.time() - started
+    elapsed = time.perf_counter() - started_counter
 
     req = stats
     req['q'] = 'report_flow'
     req['worker_id'] = worker_id
     req['blast_ip'] = blast_ip
     req['blast_port'] = blast_port
-    req['start'] = int(round(started))
-    req['duration'] = round(elapsed,2)
+    # report the start on the manager's clock so flows from all workers line up;
+    # the end is start + duration
+    req['start'] = round(managerTime(started),6)
+    req['duration'] = round(elapsed,6)
     req['direction'] = direction
-    sendRequest(manager,req,debug)
+    # the manager may have logged the flow even if we got no response, so do not send it twice
+    try:
+        sendRequest(manager,req,debug,resend=False)
+    except (OSError,ValueError) as error:
+        print("Failed to report flow to manager " + manager + ": " + str(error))
 
     if stats['bytes_sent']:
         print("NetBlast client sent",stats['bytes_sent'],"bytes to",peer_addr,"in",round(elapsed),"seconds")
@@ -221,38 +287,70 @@ def registerWorker(manager,blast_port,debug):
     worker_id = res['worker_id']
     return worker_id
 
+def testEnded():
+    return test_end_time is not None and time.time() >= test_end_time
+
+def sleepUntilRetry(retry_after):
+    # no point waiting past the end of the test, after which the manager exits
+    if test_end_time is not None and time.time() + retry_after > test_end_time:
+        retry_after = max(0,test_end_time - time.time())
+    time.sleep(retry_after)
+
 def runNetBlastWorker(manager,worker_host,worker_port,debug,worker_duration):
+    global manager_retry_until
     worker_started = time.time()
     (blast_port,blast_pid) = spawnBlastServer(worker_host,worker_port,debug)
 
-    worker_id = registerWorker(manager,blast_port,debug)
-
-    while not worker_duration or time.time() - worker_started < worker_duration:
-        req = {}
-        req['q'] = 'get_work'
-        req['worker_id'] = worker_id
-        res = sendRequest(manager,req,debug)
-        if not res['success']:
-            if res['error_msg']:
-                sys.stderr.write("Received message from manager: " + res['error_msg'] + "\n")
-            if 'reregister' in res and res['reregister']:
-                worker_id = registerWorker(manager,blast_port,debug)
-            if 'retry_after' in res:
-                time.sleep(res['retry_after'])
-                continue
-            break
+    manager_retry_until = float('inf')
+    if worker_duration:
+        manager_retry_until = worker_started + worker_duration
 
-        try:
-            blastClientProtocol(manager,worker_id,res['blast_ip'],res['blast_port'],res['blast_id'],res['duration'],res['direction'],debug)
-        except Exception as error:
-            print("Error blasting " + res['blast_ip'] + ":" + res['blast_port'] + ":",error)
-            print(traceback.format_exc())
+    try:
+        worker_id = registerWorker(manager,blast_port,debug)
+
+        while not worker_duration or time.time() - worker_started < worker_duration:
+            if testEnded(): break
+            req = {}
+            req['q'] = 'get_work'
+            req['worker_id'] = worker_id
+            res = sendRequest(manager,req,debug)
+            if not res['success']:
+                if res['error_msg']:
+                    sys.stderr.write("Received message from manager: " + res['error_msg'] + "\n")
+                if 'reregister' in res and res['reregister']:
+                    if 'retry_after' in res:
+                        sleepUntilRetry(res['retry_after'])
+                    if testEnded(): break
+                    worker_id = registerWorker(manager,blast_port,debug)
+                    continue
+                if 'retry_after' in res:
+                    sleepUntilRetry(res['retry_after'])
+                    continue
+                break
 
-    os.kill(blast_pid,signal.SIGTERM)
-    os.waitpid(blast_pid,0)
+            try:
+                blastClientProtocol(manager,worker_id,res['blast_ip'],res['blast_port'],res['blast_id'],res['duration'],res['direction'],debug)
+            except Exception as error:
+                print("Error blasting " + res['blast_ip'] + ":" + res['blast_port'] + ":",error)
+                print(traceback.format_exc())
+    except (OSError,ValueError) as error:
+        print("Giving up on manager " + manager + ": " + str(error))
+    finally:
+        os.kill(blast_pid,signal.SIGTERM)
+        os.waitpid(blast_pid,0)
 
     print("Shutting worker down after",round(time.time()-worker_started),"seconds")
 
+def printManagerStats(manager,debug):
+    req = {}
+    req['q'] = 'stats'
+    try:
+        res = sendRequest(manager,req,debug)
+    except OSError as error:
+        sys.stderr.write("Failed to connect to manager " + manager + ": " + str(error) + "\n")
+        sys.exit(1)
+    print(json.dumps(res['stats'],indent=2))
+
 def daemonize():
     if os.fork():
         sys.exit(0)
@@ -273,9 +371,14 @@ if __name__ == "__main__":
     parser.add_argument('--daemonize',action='store_true')
     parser.add_argument('--multiply',metavar='N',type=int,default=1,help='run multiple instances of the worker')
     parser.add_argument('--multiply-delay',type=float,default=0,help='number of seconds to delay between starting additional instances')
+    parser.add_argument('--stats',action='store_true',help='print the manager\'s performance statistics and exit')
 
     args = parser.parse_args()
 
+    if args.stats:
+        printManagerStats(args.manager,args.debug)
+        sys.exit(0)
+
     if args.daemonize:
         daemonize()
 